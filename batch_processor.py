@@ -4,23 +4,50 @@ Input File Splitter for GraphRAG
 Splits large input directories into manageable subdirectories based on document source.
 """
 
+import os
 import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
+from typing import List, Tuple
 
-def split_input_by_source(input_dir, batch_size=7500):
-    """Split input files into subdirectories within the input folder by document type and size."""
+def _copy_move(src, dst):
+    """Move a file across filesystems; copy2 uses copy_file_range/sendfile where available."""
+    shutil.copy2(src, dst)
+    os.unlink(src)
+
+def _move_batch(batch):
+    """Move files[start:stop] of one batch into its destination subdirectory."""
+    subdir, files, start, stop, move = batch
+    subdir_str = os.fspath(subdir)
+    for file in islice(files, start, stop):
+        move(file, subdir_str + os.sep + os.path.basename(file))
+
+def split_input_by_source(input_dir, batch_size=7500) -> List[Tuple[Path, int]]:
+    """Split input files into subdirectories within the input folder by document type and size.
+
+    Returns (subdirectory, file count) for each subdirectory created.
+    """
     input_path = Path(input_dir)
     
+    # Subdirectories live inside input_path, so they are on the same device and every
+    # move is a plain rename(2). The per-subdirectory st_dev check only matters if a
+    # pre-existing subdirectory happens to be a mount point.
+    src_dev = os.stat(input_path).st_dev
+    
     # Create subdirectories within the input folder
     created_dirs = []
+    batches = []
     
     # Group files by document prefix
-    files_by_prefix = {}
-    for file in input_path.glob("*.txt"):
-        prefix = file.name.split('_')[0]  # e.g., PRELIMusc06
-        if prefix not in files_by_prefix:
-            files_by_prefix[prefix] = []
-        files_by_prefix[prefix].append(file)
+    files_by_prefix = defaultdict(list)
+    with os.scandir(input_path) as it:
+        for entry in it:
+            name = entry.name
+            if not name.endswith('.txt') or not entry.is_file(follow_symlinks=False):
+                continue
+            files_by_prefix[name.partition('_')[0]].append(entry.path)  # e.g., PRELIMusc06
     
     print(f"Found {len(files_by_prefix)} document types:")
     for prefix, files in files_by_prefix.items():
@@ -35,26 +62,31 @@ def split_input_by_source(input_dir, batch_size=7500):
             # Small enough - create single subdirectory
             subdir = input_path / prefix
             subdir.mkdir(exist_ok=True)
-            created_dirs.append(subdir)
-            
-            for file in files:
-                shutil.move(str(file), str(subdir / file.name))
+            move = os.rename if os.stat(subdir).st_dev == src_dev else _copy_move
+            created_dirs.append((subdir, len(files)))
+            batches.append((subdir, files, 0, len(files), move))
             
             print(f"  → Created {prefix}/ ({len(files):,} files)")
             
         else:
             # Too large - split into multiple subdirectories
-            chunks = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
-            
-            for i, chunk in enumerate(chunks, 1):
+            # Batches hold index ranges into files rather than sliced copies
+            for i, start in enumerate(range(0, len(files), batch_size), 1):
+                stop = min(start + batch_size, len(files))
                 subdir = input_path / f"{prefix}_part{i}"
                 subdir.mkdir(exist_ok=True)
-                created_dirs.append(subdir)
+                move = os.rename if os.stat(subdir).st_dev == src_dev else _copy_move
+                created_dirs.append((subdir, stop - start))
+                batches.append((subdir, files, start, stop, move))
                 
-                for file in chunk:
-                    shutil.move(str(file), str(subdir / file.name))
-                
-                print(f"  → Created {prefix}_part{i}/ ({len(chunk):,} files)")
+                print(f"  → Created {prefix}_part{i}/ ({stop - start:,} files)")
+    
+    # Subdirectories are all created above; move files with one worker per
+    # subdirectory so workers don't contend on the same directory lock
+    print(f"\nMoving files into {len(batches)} subdirectories...")
+    max_workers = min(16, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(_move_batch, batches))
     
     return created_dirs
 
@@ -65,7 +97,10 @@ def main():
     print("Input File Organizer for GraphRAG")
     print("=" * 40)
     print(f"Directory: {input_dir}")
-    print(f"Total files: {len(list(input_dir.glob('*.txt'))):,}")
+    with os.scandir(input_dir) as it:
+        # Same filter as split_input_by_source so the totals agree
+        total_txt = sum(1 for e in it if e.name.endswith('.txt') and e.is_file(follow_symlinks=False))
+    print(f"Total files: {total_txt:,}")
     
     print(f"\nThis will organize files into subdirectories within {input_dir.name}/")
     print("Example structure after organization:")
@@ -88,11 +123,9 @@ def main():
     print(f"{'='*60}")
     print(f"Created {len(created_dirs)} subdirectories within {input_dir.name}/:")
     
-    total_files = 0
-    for subdir in created_dirs:
-        file_count = len(list(subdir.glob("*.txt")))
-        total_files += file_count
-        print(f"  - {subdir.name}/: {file_count:,} files")
+    total_files = sum(n for _, n in created_dirs)
+    for subdir, n in created_dirs:
+        print(f"  - {subdir.name}/: {n:,} files")
     
     print(f"\nTotal files organized: {total_files:,}")
     
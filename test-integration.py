@@ -1,8 +1,8 @@
 import os
 import subprocess
 import sys
+import tempfile
 from typing import List
-from io import StringIO
 from langchain_core.documents import Document
 from langchain_text_splitters import HTMLSectionSplitter, RecursiveCharacterTextSplitter
 
@@ -57,10 +57,11 @@ def run_auto_prompt_tuning(workspace_path: str, config_path: str = None):
         cmd.append("--no-discover-entity-types")
     
     try:
-        # Set environment variable to disable numba caching to avoid hyppo library issues
+        # Give numba a fresh cache dir to avoid hyppo library cache issues while keeping JIT enabled
         env = os.environ.copy()
-        env["NUMBA_DISABLE_JIT"] = "1"
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True, env=env)
+        with tempfile.TemporaryDirectory(prefix="numba_cache_") as numba_cache_dir:
+            env["NUMBA_CACHE_DIR"] = numba_cache_dir
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True, env=env)
         print("[SUCCESS] Auto prompt tuning completed successfully!")
         print(f"[INFO] Generated prompts saved to: {os.path.join(workspace_path, AUTO_TUNING_CONFIG['output'])}")
         return True
@@ -69,6 +70,31 @@ def run_auto_prompt_tuning(workspace_path: str, config_path: str = None):
         print(f"[ERROR] stderr: {e.stderr}")
         return False
 
+def run_graphrag_query(workspace_path: str, query: str, method: str = "local"):
+    """
+    Run a GraphRAG query, streaming its output as it arrives instead of buffering it until exit.
+    stderr is inherited so rate-limit or auth errors show up live as well.
+    """
+    cmd = [
+        sys.executable, "-m", "graphrag", "query",
+        "--root", workspace_path,
+        "--method", method,
+        "--query", query
+    ]
+    env = os.environ.copy()
+    env["PYTHONUNBUFFERED"] = "1"
+    
+    print("\n================= QUERY RESULT =================")
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1, env=env) as proc:
+        for line in proc.stdout:
+            sys.stdout.write(line)
+        rc = proc.wait()
+    print("================================================\n")
+    
+    if rc != 0:
+        print("❌ Graphrag failed!")
+        raise subprocess.CalledProcessError(rc, cmd)
+
 
 
 
@@ -86,8 +112,7 @@ def parse_html_to_chunks(html_path: str, headers_to_split_on=None, chunk_size: i
     splitter = HTMLSectionSplitter(headers_to_split_on)
     with open(html_path, "r", encoding="utf-8") as f:
         html_str = f.read()
-        html_buffer = StringIO(html_str)
-    html_splits = splitter.split_text_from_file(html_buffer)
+    html_splits = splitter.split_text(html_str)
     # Further split large sections if needed
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     chunks = text_splitter.split_documents(html_splits)
@@ -153,31 +178,16 @@ if os.path.exists(output_dir):
 
 if not indexing_complete:
     print("[INFO] Indexing input file with GraphRAG...")
-    # Set environment variable to disable numba caching to avoid hyppo library issues
+    # Give numba a fresh cache dir to avoid hyppo library cache issues while keeping JIT enabled
     env = os.environ.copy()
-    env["NUMBA_DISABLE_JIT"] = "1"
-    subprocess.run([sys.executable, "-m", "graphrag", "index", "--root", WORKSPACE], check=True, env=env)
+    # Unbuffered child output so indexing progress shows up as it happens
+    env["PYTHONUNBUFFERED"] = "1"
+    with tempfile.TemporaryDirectory(prefix="numba_cache_") as numba_cache_dir:
+        env["NUMBA_CACHE_DIR"] = numba_cache_dir
+        subprocess.run([sys.executable, "-m", "graphrag", "index", "--root", WORKSPACE], check=True, env=env)
 else:
     print("[INFO] Using existing indexed data")
 
 # --- Run a query ---
 print("[INFO] Running a query with GraphRAG...")
-try:
-    result = subprocess.run([
-        sys.executable, "-m", "graphrag", "query",
-        "--root", WORKSPACE,
-        "--method", "local",
-        "--query", QUERY
-    ], capture_output=True, text=True, check=True)
-
-except subprocess.CalledProcessError as e:
-    print("❌ Graphrag failed!")
-    print("STDOUT:")
-    print(e.stdout)
-    print("STDERR:")
-    print(e.stderr)   # ← here’s where the rate‑limit or 401 messages will live
-    raise
-
-print("\n================= QUERY RESULT =================")
-print(result.stdout)
-print("================================================\n") 
\ No newline at end of file
+run_graphrag_query(WORKSPACE, QUERY)